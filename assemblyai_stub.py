@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+import uuid
+import random
+import logging
+import requests
+from flask import Flask, request, abort, jsonify
+
+PORT = int(os.environ.get("STUB_PORT", "8089"))
+STUB_BASE_URL = os.environ.get("STUB_BASE_URL", f"http://127.0.0.1:{PORT}")
+STUB_DELAY = float(os.environ.get("STUB_DELAY", "5"))
+STUB_ERROR_RATE = float(os.environ.get("STUB_ERROR_RATE", "0"))
+STUB_TEXT = os.environ.get("STUB_TEXT", "This is a stub transcript.")
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+app = Flask(__name__)
+uploads = {}
+transcripts = {}
+lock = threading.Lock()
+stats = {"uploads": 0, "creates": 0, "polls": 0, "webhooks": 0}
+
+def require_key():
+    if not request.headers.get("authorization"):
+        abort(401)
+
+def complete_later(transcript_id, payload):
+    time.sleep(STUB_DELAY)
+    failed = random.random() < STUB_ERROR_RATE
+    with lock:
+        t = transcripts[transcript_id]
+        t["status"] = "error" if failed else "completed"
+        t["error"] = "Stub failure" if failed else None
+        t["text"] = None if failed else STUB_TEXT
+    webhook_url = payload.get("webhook_url")
+    if not webhook_url:
+        return
+    headers = {}
+    if payload.get("webhook_auth_header_name"):
+        headers[payload["webhook_auth_header_name"]] = payload.get("webhook_auth_header_value", "")
+    try:
+        requests.post(webhook_url, json={"transcript_id": transcript_id, "status": t["status"]}, headers=headers, timeout=10)
+        stats["webhooks"] += 1
+    except Exception as e:
+        logging.warning("Stub webhook delivery failed: %s", e)
+
+@app.route("/v2/upload", methods=["POST"])
+def upload():
+    require_key()
+    upload_id = uuid.uuid4().hex
+    with lock:
+        uploads[upload_id] = len(request.get_data())
+        stats["uploads"] += 1
+    return jsonify({"upload_url": f"{STUB_BASE_URL}/files/{upload_id}"})
+
+@app.route("/v2/transcript", methods=["POST"])
+def create_transcript():
+    require_key()
+    payload = request.get_json(silent=True) or {}
+    if not payload.get("audio_url"):
+        abort(400)
+    transcript_id = uuid.uuid4().hex
+    with lock:
+        transcripts[transcript_id] = {"id": transcript_id, "status": "queued", "text": None, "error": None}
+        stats["creates"] += 1
+    threading.Thread(target=complete_later, args=(transcript_id, payload), daemon=True).start()
+    return jsonify({"id": transcript_id, "status": "queued"})
+
+@app.route("/v2/transcript/<transcript_id>", methods=["GET"])
+def get_transcript(transcript_id):
+    require_key()
+    with lock:
+        stats["polls"] += 1
+        t = transcripts.get(transcript_id)
+        if not t:
+            abort(404)
+        return jsonify(dict(t))
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    return jsonify(stats)
+
+if __name__ == "__main__":
+    app.run(host="127.0.0.1", port=PORT, threaded=True)
@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+from fake_services import FakeServices, DEFAULT_LATENCY
+
+SAMPLES = {
+    "voice": {"field": "voice", "ext": "ogg", "args": ["-f", "lavfi", "-i", "sine=frequency=220:duration={d}", "-acodec", "libopus", "-b:a", "32k"], "duration": 20},
+    "audio": {"field": "audio", "ext": "mp3", "args": ["-f", "lavfi", "-i", "sine=frequency=330:duration={d}", "-acodec", "libmp3lame", "-b:a", "64k"], "duration": 120},
+    "video": {"field": "video", "ext": "mp4", "args": ["-f", "lavfi", "-i", "testsrc=size=320x240:rate=15:duration={d}", "-f", "lavfi", "-i", "sine=frequency=440:duration={d}", "-shortest", "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac"], "duration": 30},
+}
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[idx]
+
+def summarize(values):
+    return {"count": len(values), "mean": sum(values) / len(values) if values else None, "p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99)}
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in SAMPLES:
+            raise SystemExit(f"Unknown media kind: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def make_samples(ffmpeg, workdir, kinds, scale):
+    samples = {}
+    for kind in kinds:
+        spec = SAMPLES[kind]
+        duration = max(1, int(spec["duration"] * scale))
+        path = os.path.join(workdir, f"sample_{kind}.{spec['ext']}")
+        args = [a.format(d=duration) for a in spec["args"]]
+        subprocess.run([ffmpeg, "-v", "error"] + args + [path, "-y"], check=True)
+        with open(path, "rb") as f:
+            samples[kind] = {"data": f.read(), "duration": duration}
+    return samples
+
+def build_update(n, kind, uid, file_id, size, duration):
+    media = {"file_id": file_id, "file_unique_id": f"uniq{n}", "file_size": size, "duration": duration}
+    if kind == "video":
+        media.update({"width": 320, "height": 240})
+    return {"update_id": n, "message": {"message_id": n, "date": int(time.time()), "chat": {"id": uid, "type": "private"}, "from": {"id": uid, "is_bot": False, "first_name": "Bench"}, SAMPLES[kind]["field"]: media}}
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the transcription pipeline using local Gemini/Telegram stand-ins.")
+    parser.add_argument("--rate", type=float, default=2.0, help="updates per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to generate load")
+    parser.add_argument("--users", type=int, default=20, help="distinct synthetic users")
+    parser.add_argument("--mix", default="voice=0.7,audio=0.2,video=0.1", help="media mix, e.g. voice=0.7,audio=0.2,video=0.1")
+    parser.add_argument("--sample-scale", type=float, default=1.0, help="multiplier for synthetic media durations")
+    parser.add_argument("--gemini-latency", type=float, default=DEFAULT_LATENCY["generate"], help="mean generateContent latency in seconds")
+    parser.add_argument("--upload-latency", type=float, default=DEFAULT_LATENCY["upload"], help="mean Files API upload latency in seconds")
+    parser.add_argument("--telegram-latency", type=float, default=DEFAULT_LATENCY["telegram"], help="mean Bot API latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of Gemini calls answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of Gemini calls answered with 429")
+    parser.add_argument("--drain-timeout", type=float, default=120.0, help="seconds to wait for in-flight jobs after load stops")
+    parser.add_argument("--stream", action="store_true", help="stream transcripts with progressive edits (latency then measures time to first text)")
+    parser.add_argument("--cache", action="store_true", help="allow transcript cache hits between identical samples")
+    parser.add_argument("--json", help="write the report to this file as JSON")
+    args = parser.parse_args()
+
+    ffmpeg = os.environ.get("FFMPEG_BINARY") or shutil.which("ffmpeg")
+    if not ffmpeg:
+        raise SystemExit("ffmpeg is required to build samples and run the pipeline")
+    mix = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    samples = make_samples(ffmpeg, workdir, mix, args.sample_scale)
+
+    fake = FakeServices(latency={"generate": args.gemini_latency, "upload": args.upload_latency, "telegram": args.telegram_latency, "download": args.telegram_latency}, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
+    base = fake.start()
+
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCH",
+        "FFMPEG_BINARY": ffmpeg,
+        "GEMINI_API_BASE": base,
+        "MONGO_URI": "invalid://",
+        "MONGO_WAIT_TIMEOUT": "0",
+        "REQUIRED_CHANNEL": "",
+        "STATE_BACKEND": "memory",
+        "STREAM_TRANSCRIPTS": "1" if args.stream else "0",
+        "DOWNLOADS_DIR": os.path.join(workdir, "downloads"),
+        "TRANSCRIPT_CACHE_DB": os.path.join(workdir, "transcripts.db"),
+    })
+    if not args.cache:
+        os.environ["TRANSCRIPT_CACHE_TTL"] = "-1"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import telebot
+    import main as bot_main
+    telebot.apihelper.API_URL = base + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = base + "/file/bot{0}/{1}"
+
+    stages = {}
+    stages_lock = threading.Lock()
+    def record(stage, seconds):
+        with stages_lock:
+            stages.setdefault(stage, []).append(seconds)
+
+    original_http = bot_main.http_request
+    def timed_http(method, url, *a, **kw):
+        start = time.time()
+        try:
+            return original_http(method, url, *a, **kw)
+        finally:
+            if "/file/bot" in url:
+                stage = "download"
+            elif "/upload/v1beta/files" in url:
+                stage = "upload"
+            elif "generatecontent" in url.lower():
+                stage = "generate"
+            elif "/v1beta/files/" in url:
+                stage = "delete"
+            else:
+                stage = "telegram_api"
+            record(stage, time.time() - start)
+    bot_main.http_request = timed_http
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = bot_main.telegram_request
+
+    def timed(stage, fn):
+        def wrapper(*a, **kw):
+            start = time.time()
+            try:
+                return fn(*a, **kw)
+            finally:
+                record(stage, time.time() - start)
+        return wrapper
+    bot_main.transcode_audio = timed("transcode", bot_main.transcode_audio)
+    bot_main.send_long_text = timed("send_long_text", bot_main.send_long_text)
+
+    started, finished, failed = {}, {}, set()
+    done_lock = threading.Lock()
+    def on_reply(message_id, method, text):
+        with done_lock:
+            if message_id in started and message_id not in finished:
+                finished[message_id] = time.time()
+                if text.startswith("❌") or text.startswith("Please wait"):
+                    failed.add(message_id)
+    fake.on_reply = on_reply
+
+    for uid in range(1, args.users + 1):
+        bot_main.user_gemini_keys.set(uid, "AIzaBench", 10 ** 9)
+
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    rng = random.Random(1234)
+    client = bot_main.flask_app.test_client()
+    total = int(args.rate * args.duration)
+    rejected = 0
+    t0 = time.time()
+    for n in range(1, total + 1):
+        target = t0 + (n - 1) / args.rate
+        delay = target - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        kind = rng.choices(kinds, weights)[0]
+        file_id = f"bench/{kind}/{n}"
+        fake.files[file_id] = samples[kind]["data"]
+        update = build_update(n, kind, 1 + n % args.users, file_id, len(samples[kind]["data"]), samples[kind]["duration"])
+        with done_lock:
+            started[n] = time.time()
+        resp = client.post(bot_main.WEBHOOK_PATH, data=json.dumps(update), content_type="application/json")
+        if resp.status_code != 200:
+            rejected += 1
+            with done_lock:
+                started.pop(n, None)
+    load_end = time.time()
+
+    deadline = load_end + args.drain_timeout
+    while time.time() < deadline:
+        with done_lock:
+            if len(finished) >= len(started):
+                break
+        time.sleep(0.2)
+    end = time.time()
+
+    with done_lock:
+        latencies = [finished[n] - started[n] for n in finished if n not in failed]
+        completed = len(finished) - len(failed)
+        timed_out = len(started) - len(finished)
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    report = {
+        "config": vars(args),
+        "submitted": total,
+        "rejected": rejected,
+        "completed": completed,
+        "failed": len(failed),
+        "timed_out": timed_out,
+        "wall_seconds": end - t0,
+        "throughput_per_sec": completed / (end - t0) if end > t0 else None,
+        "latency": summarize(latencies),
+        "stages": {stage: summarize(values) for stage, values in sorted(stages.items())},
+        "peak_rss_mb": round(self_rss / 1024.0, 1),
+        "peak_child_rss_mb": round(child_rss / 1024.0, 1),
+        "fake_calls": dict(fake.counts),
+        "http_stats": bot_main.get_http_stats(),
+    }
+
+    print(f"submitted={total} rejected={rejected} completed={completed} failed={len(failed)} timed_out={timed_out}")
+    print(f"throughput={report['throughput_per_sec']:.2f}/s wall={report['wall_seconds']:.1f}s peak_rss={report['peak_rss_mb']}MB peak_ffmpeg_rss={report['peak_child_rss_mb']}MB")
+    lat = report["latency"]
+    if lat["count"]:
+        print(f"end-to-end p50={lat['p50']:.2f}s p95={lat['p95']:.2f}s p99={lat['p99']:.2f}s")
+    for stage, st in report["stages"].items():
+        print(f"  {stage:<15} n={st['count']:<6} mean={st['mean']:.3f}s p95={st['p95']:.3f}s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    fake.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
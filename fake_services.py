@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from flask import Flask, request, jsonify, Response
+from werkzeug.serving import make_server
+
+PORT = int(os.environ.get("FAKE_PORT", "8090"))
+FAKE_TEXT = os.environ.get("FAKE_TEXT", "This is a fake transcript produced by the local Gemini stand-in.")
+
+STREAM_FIRST_SHARE = 0.3
+
+DEFAULT_LATENCY = {"upload": 0.3, "generate": 1.5, "delete": 0.05, "download": 0.1, "telegram": 0.05}
+
+class FakeServices:
+    def __init__(self, latency=None, jitter=0.2, error_rate=0.0, rate_limit_rate=0.0, retry_after=1, text=FAKE_TEXT):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.text = text
+        self.files = {}
+        self.on_reply = None
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.message_ids = iter(range(10 ** 6, 10 ** 9))
+        self.app = self._build_app()
+        self.server = None
+
+    def _delay(self, kind, share=1.0):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+        base = self.latency.get(kind, 0) * share
+        if base:
+            time.sleep(max(0, random.gauss(base, base * self.jitter)))
+
+    def _fault(self):
+        r = random.random()
+        if r < self.rate_limit_rate:
+            with self.lock:
+                self.counts["429"] = self.counts.get("429", 0) + 1
+            return Response(json.dumps({"error": {"code": 429, "message": "Resource exhausted"}}), status=429, headers={"Retry-After": str(self.retry_after)}, mimetype="application/json")
+        if r < self.rate_limit_rate + self.error_rate:
+            with self.lock:
+                self.counts["500"] = self.counts.get("500", 0) + 1
+            return Response(json.dumps({"error": {"code": 500, "message": "Internal error"}}), status=500, mimetype="application/json")
+        return None
+
+    def _message(self, chat_id, text=None):
+        msg = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}, "from": {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}}
+        if text is not None:
+            msg["text"] = text
+        return msg
+
+    def _build_app(self):
+        app = Flask("fake_services")
+
+        @app.route("/upload/v1beta/files", methods=["POST"])
+        def gemini_upload():
+            request.get_data()
+            self._delay("upload")
+            fault = self._fault()
+            if fault is not None:
+                return fault
+            name = f"files/{uuid.uuid4().hex}"
+            return jsonify({"file": {"name": name, "uri": f"{request.host_url.rstrip('/')}/v1beta/{name}"}})
+
+        @app.route("/v1beta/models/<path:spec>", methods=["POST"])
+        def gemini_generate(spec):
+            request.get_data()
+            streaming = spec.endswith(":streamGenerateContent")
+            self._delay("generate", STREAM_FIRST_SHARE if streaming else 1.0)
+            fault = self._fault()
+            if fault is not None:
+                return fault
+            if streaming:
+                words = self.text.split(" ")
+                pieces = [" ".join(words[i:i + 4]) + (" " if i + 4 < len(words) else "") for i in range(0, len(words), 4)]
+                gap = self.latency.get("generate", 0) * (1 - STREAM_FIRST_SHARE) / len(pieces)
+                def events():
+                    for i, piece in enumerate(pieces):
+                        if i: time.sleep(gap)
+                        yield f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': piece}]}}]})}\r\n\r\n"
+                return Response(events(), mimetype="text/event-stream")
+            return jsonify({"candidates": [{"content": {"parts": [{"text": self.text}]}}]})
+
+        @app.route("/v1beta/files/<name>", methods=["DELETE"])
+        def gemini_delete(name):
+            self._delay("delete")
+            return jsonify({})
+
+        @app.route("/file/bot<token>/<path:file_path>", methods=["GET"])
+        def telegram_file(token, file_path):
+            self._delay("download")
+            data = self.files.get(file_path)
+            if data is None:
+                return Response(status=404)
+            return Response(data, mimetype="application/octet-stream")
+
+        @app.route("/bot<token>/<method>", methods=["GET", "POST"])
+        def telegram_api(token, method):
+            self._delay("telegram")
+            params = dict(request.values)
+            params.update(request.get_json(silent=True) or {})
+            chat_id = params.get("chat_id", 0)
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+            elif method == "getFile":
+                file_id = params.get("file_id", "")
+                result = {"file_id": file_id, "file_unique_id": file_id, "file_path": file_id, "file_size": len(self.files.get(file_id, b""))}
+            elif method == "getChatMember":
+                result = {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "User"}}
+            elif method in ("sendMessage", "sendDocument", "editMessageText"):
+                text = params.get("text") or params.get("caption") or ""
+                result = self._message(chat_id, text)
+                reply_to = params.get("reply_to_message_id")
+                if reply_to is None and params.get("reply_parameters"):
+                    try:
+                        reply_to = json.loads(params["reply_parameters"]).get("message_id")
+                    except Exception:
+                        reply_to = None
+                if reply_to is not None and self.on_reply and method != "editMessageText":
+                    self.on_reply(int(reply_to), method, text)
+            elif method == "editMessageReplyMarkup":
+                result = self._message(chat_id)
+            else:
+                result = True
+            return jsonify({"ok": True, "result": result})
+
+        return app
+
+    def start(self, host="127.0.0.1", port=0):
+        self.server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, name="fake-services", daemon=True).start()
+        return f"http://{host}:{self.server.server_port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    fake = FakeServices(error_rate=float(os.environ.get("FAKE_ERROR_RATE", "0")), rate_limit_rate=float(os.environ.get("FAKE_429_RATE", "0")))
+    base = fake.start(port=PORT)
+    logging.info("Fake Gemini/Telegram services on %s (GEMINI_API_BASE=%s)", base, base)
+    while True:
+        time.sleep(3600)
@@ -1,17 +1,35 @@
 import os
+import time
+STARTED_AT = time.time()
 import threading
 import json
 import requests
 import logging
-import time
 import subprocess
-from flask import Flask, request, abort
+import hashlib
+import sqlite3
+import io
+import base64
+import random
+import zlib
+import sys
+import traceback
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+import re
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from flask import Flask, Response, request, abort
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Update
 import pymongo
 from requests.exceptions import HTTPError
 
 FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "/usr/bin/ffmpeg")
+FFPROBE_BINARY = os.environ.get("FFPROBE_BINARY", os.path.join(os.path.dirname(FFMPEG_BINARY), "ffprobe"))
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 WEBHOOK_URL_BASE = os.environ.get("WEBHOOK_URL_BASE", "")
 PORT = int(os.environ.get("PORT", "8080"))
@@ -23,9 +41,69 @@ MAX_UPLOAD_SIZE = MAX_UPLOAD_MB * 1024 * 1024
 MAX_MESSAGE_CHUNK = 4095
 GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
 GEMINI_FALLBACK_MODEL = os.environ.get("GEMINI_FALLBACK_MODEL", "gemini-2.5-flash-lite")
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip('/')
 REQUIRED_CHANNEL = os.environ.get("REQUIRED_CHANNEL", "")
 DOWNLOADS_DIR = os.environ.get("DOWNLOADS_DIR", "./downloads")
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(256 * 1024)))
 ADMIN_ID = 5240873494
+WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "4"))
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "200"))
+MAX_USER_QUEUE = int(os.environ.get("MAX_USER_QUEUE", "5"))
+MAX_USER_INFLIGHT = int(os.environ.get("MAX_USER_INFLIGHT", "1"))
+CONTROL_WORKER_COUNT = int(os.environ.get("CONTROL_WORKER_COUNT", "2"))
+DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", "5000"))
+TRANSCRIPT_CACHE_SIZE = int(os.environ.get("TRANSCRIPT_CACHE_SIZE", "10000"))
+TRANSCRIPT_CACHE_TTL = int(os.environ.get("TRANSCRIPT_CACHE_TTL", str(30 * 24 * 3600)))
+TRANSCRIPT_CACHE_DB = os.environ.get("TRANSCRIPT_CACHE_DB", "./transcripts.db")
+CHUNK_MAX_SECONDS = int(os.environ.get("CHUNK_MAX_SECONDS", "600"))
+CHUNK_MIN_SECONDS = int(os.environ.get("CHUNK_MIN_SECONDS", "300"))
+CHUNK_CONCURRENCY = int(os.environ.get("CHUNK_CONCURRENCY", "3"))
+CHUNK_TAIL_MIN_SECONDS = int(os.environ.get("CHUNK_TAIL_MIN_SECONDS", "30"))
+CHUNK_RETRIES = int(os.environ.get("CHUNK_RETRIES", "2"))
+SILENCE_NOISE_DB = os.environ.get("SILENCE_NOISE_DB", "-35dB")
+SILENCE_MIN_DURATION = float(os.environ.get("SILENCE_MIN_DURATION", "0.5"))
+TRANSCODE_PROFILE = os.environ.get("TRANSCODE_PROFILE", "opus")
+TRIM_SILENCE = os.environ.get("TRIM_SILENCE", "0") == "1"
+TRIM_NOISE_DB = os.environ.get("TRIM_NOISE_DB", "-40dB")
+TRIM_MIN_SILENCE = float(os.environ.get("TRIM_MIN_SILENCE", "1.0"))
+TRIM_KEEP_SILENCE = float(os.environ.get("TRIM_KEEP_SILENCE", "0.3"))
+SPEECH_TEMPO = float(os.environ.get("SPEECH_TEMPO", "1.0"))
+INLINE_MAX_MB = float(os.environ.get("INLINE_MAX_MB", "4"))
+INLINE_MAX_SIZE = int(INLINE_MAX_MB * 1024 * 1024)
+DELETE_BATCH_INTERVAL = float(os.environ.get("DELETE_BATCH_INTERVAL", "5"))
+DELETE_MAX_ATTEMPTS = int(os.environ.get("DELETE_MAX_ATTEMPTS", "5"))
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "10"))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "32"))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "1"))
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", "30"))
+HTTP_RETRY_AFTER_MAX = float(os.environ.get("HTTP_RETRY_AFTER_MAX", "60"))
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_DB = os.environ.get("STATE_DB", "./state.db")
+STATE_MAX_ENTRIES = int(os.environ.get("STATE_MAX_ENTRIES", "20000"))
+STATE_TTL = int(os.environ.get("STATE_TTL", str(3 * 24 * 3600)))
+STATE_PREF_TTL = int(os.environ.get("STATE_PREF_TTL", str(365 * 24 * 3600)))
+STATE_PREF_MAX_ENTRIES = int(os.environ.get("STATE_PREF_MAX_ENTRIES", "200000"))
+STATE_COMPRESS_MIN = int(os.environ.get("STATE_COMPRESS_MIN", "512"))
+MEMBER_CACHE_TTL = int(os.environ.get("MEMBER_CACHE_TTL", "600"))
+MEMBER_CACHE_NEGATIVE_TTL = int(os.environ.get("MEMBER_CACHE_NEGATIVE_TTL", "30"))
+MEMBER_CACHE_SIZE = int(os.environ.get("MEMBER_CACHE_SIZE", "50000"))
+CHANNEL_INFO_TTL = int(os.environ.get("CHANNEL_INFO_TTL", "600"))
+USER_KEY_CACHE_SIZE = int(os.environ.get("USER_KEY_CACHE_SIZE", "20000"))
+USER_KEY_CACHE_TTL = int(os.environ.get("USER_KEY_CACHE_TTL", "300"))
+USER_KEY_MISS_TTL = int(os.environ.get("USER_KEY_MISS_TTL", "60"))
+KEY_FLUSH_INTERVAL = float(os.environ.get("KEY_FLUSH_INTERVAL", "2"))
+MONGO_WAIT_TIMEOUT = float(os.environ.get("MONGO_WAIT_TIMEOUT", "10"))
+ACTION_CACHE_TTL = int(os.environ.get("ACTION_CACHE_TTL", str(7 * 24 * 3600)))
+TRANSLATE_PREFETCH_LANGS = [c.strip() for c in os.environ.get("TRANSLATE_PREFETCH_LANGS", "").split(",") if c.strip()]
+TRANSLATE_BATCH_MAX_CHARS = int(os.environ.get("TRANSLATE_BATCH_MAX_CHARS", "6000"))
+SUMMARY_CHUNK_CHARS = int(os.environ.get("SUMMARY_CHUNK_CHARS", "20000"))
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+PROFILE_SLOW_SECONDS = float(os.environ.get("PROFILE_SLOW_SECONDS", "0"))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.05"))
+STREAM_TRANSCRIPTS = os.environ.get("STREAM_TRANSCRIPTS", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.environ.get("STREAM_GROUP_EDIT_INTERVAL", "3"))
 
 DB_USER = os.environ.get("DB_USER", "")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
@@ -35,7 +113,6 @@ MONGO_URI = os.environ.get("MONGO_URI") or f"mongodb+srv://{DB_USER}:{DB_PASSWOR
 os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-user_gemini_keys = {}
 LANGS = [
 ("🇬🇧 English","en"), ("🇸🇦 العربية","ar"), ("🇪🇸 Español","es"), ("🇫🇷 Français","fr"),
 ("🇷🇺 Русский","ru"), ("🇩🇪 Deutsch","de"), ("🇮🇳 हिन्दी","hi"), ("🇮🇷 فارسی","fa"),
@@ -51,146 +128,983 @@ LANGS = [
 ("🇺🇿 O'zbekcha","uz"), ("🇵🇭 Tagalog","tl"), ("🇵🇹 Português","pt")
 ]
 
-user_mode = {}
-user_transcriptions = {}
-action_usage = {}
-
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 flask_app = Flask(__name__)
 
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+    def inc(self, name, value=1, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+    def gauge_add(self, name, value, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[k] = self.gauges.get(k, 0) + value
+    def observe(self, name, value, **labels):
+        k = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.setdefault(k, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, le in enumerate(self.buckets):
+                if value <= le: h["buckets"][i] += 1
+            h["sum"] += value
+            h["count"] += 1
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe("bot_stage_seconds", time.time() - start, stage=stage)
+
+def _labels(labels):
+    if not labels: return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+def render_metrics(extra_gauges=(), extra_counters=()):
+    lines = []
+    with metrics.lock:
+        counters = dict(metrics.counters)
+        gauges = dict(metrics.gauges)
+        histograms = {k: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]} for k, h in metrics.histograms.items()}
+    for (name, labels), value in extra_counters:
+        counters[(name, labels)] = value
+    for (name, labels), value in extra_gauges:
+        gauges[(name, labels)] = value
+    for kind, series in (("counter", counters), ("gauge", gauges)):
+        for name in sorted(set(n for n, _ in series)):
+            lines.append(f"# TYPE {name} {kind}")
+            for (n, labels), value in sorted(series.items()):
+                if n == name: lines.append(f"{name}{_labels(labels)} {value}")
+    for name in sorted(set(n for n, _ in histograms)):
+        lines.append(f"# TYPE {name} histogram")
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name: continue
+            for le, count in zip(metrics.buckets, h["buckets"]):
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {count}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {h['count']}")
+            lines.append(f"{name}_sum{_labels(labels)} {h['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {h['count']}")
+    return "\n".join(lines) + "\n"
+
+metrics = Metrics(STAGE_BUCKETS)
+
+@contextmanager
+def profile_if_slow(label):
+    if PROFILE_SLOW_SECONDS <= 0:
+        yield
+        return
+    ident = threading.get_ident()
+    samples = {}
+    done = threading.Event()
+    def sample():
+        while not done.wait(PROFILE_INTERVAL):
+            frame = sys._current_frames().get(ident)
+            if frame is None: continue
+            stack = tuple(f"{fs.name} ({os.path.basename(fs.filename)}:{fs.lineno})" for fs in traceback.extract_stack(frame)[-8:])
+            samples[stack] = samples.get(stack, 0) + 1
+    sampler = threading.Thread(target=sample, name="slow-profiler", daemon=True)
+    start = time.time()
+    sampler.start()
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+        elapsed = time.time() - start
+        if elapsed >= PROFILE_SLOW_SECONDS and samples:
+            total = sum(samples.values())
+            top = sorted(samples.items(), key=lambda kv: -kv[1])[:5]
+            report = "\n".join(f"  {count * 100 // total}% " + " <- ".join(reversed(stack)) for stack, count in top)
+            logging.warning("Slow %s took %.2fs, top stacks:\n%s", label, elapsed, report)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+UNSENT_RETRY_STATUSES = (429, 503)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+http_stats = {}
+http_stats_lock = threading.Lock()
+
+def record_http(host, seconds, error=False, retry=False):
+    with http_stats_lock:
+        st = http_stats.setdefault(host, {"requests": 0, "errors": 0, "retries": 0, "seconds": 0.0})
+        st["requests"] += 1
+        st["seconds"] += seconds
+        if error: st["errors"] += 1
+        if retry: st["retries"] += 1
+
+def get_http_stats():
+    with http_stats_lock:
+        return {host: dict(st) for host, st in http_stats.items()}
+
+def retry_delay(attempt, resp=None):
+    if resp is not None:
+        after = resp.headers.get("Retry-After")
+        if after is None and resp.status_code == 429:
+            try: after = resp.json().get("parameters", {}).get("retry_after")
+            except Exception: after = None
+        if after is not None:
+            try:
+                delay = float(after)
+            except (TypeError, ValueError):
+                try: delay = parsedate_to_datetime(after).timestamp() - time.time()
+                except Exception: delay = None
+            if delay is not None:
+                return min(max(delay, 0), HTTP_RETRY_AFTER_MAX)
+    cap = min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt))
+    return cap / 2 + random.uniform(0, cap / 2)
+
+def _rewind(kwargs):
+    bodies = [kwargs.get("data")] + list((kwargs.get("files") or {}).values())
+    for body in bodies:
+        if isinstance(body, (tuple, list)) and len(body) > 1: body = body[1]
+        if hasattr(body, "seek"):
+            try: body.seek(0)
+            except Exception: return False
+        elif hasattr(body, "read"):
+            return False
+    return True
+
+def _never_sent(exc):
+    if isinstance(exc, requests.ConnectTimeout): return True
+    if not isinstance(exc, requests.ConnectionError): return False
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+def http_request(method, url, retry_statuses=RETRY_STATUSES, max_retries=None, **kwargs):
+    host = urlsplit(url).hostname or ""
+    max_retries = HTTP_MAX_RETRIES if max_retries is None else max_retries
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    if not idempotent:
+        retry_statuses = tuple(s for s in retry_statuses if s in UNSENT_RETRY_STATUSES)
+    for attempt in range(max_retries + 1):
+        start = time.time()
+        try:
+            resp = http_session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            record_http(host, time.time() - start, error=True, retry=attempt > 0)
+            if attempt >= max_retries or not (idempotent or _never_sent(e)) or not _rewind(kwargs): raise
+            logging.warning("HTTP %s %s failed (%s), retrying", method, host, e)
+            time.sleep(retry_delay(attempt))
+            continue
+        record_http(host, time.time() - start, error=resp.status_code >= 400, retry=attempt > 0)
+        if resp.status_code not in retry_statuses or attempt >= max_retries or not _rewind(kwargs):
+            return resp
+        delay = retry_delay(attempt, resp)
+        logging.warning("HTTP %s %s returned %s, retrying in %.1fs", method, host, resp.status_code, delay)
+        resp.close()
+        time.sleep(delay)
+
+telegram_retries = threading.local()
+
+@contextmanager
+def no_telegram_retries():
+    telegram_retries.off = True
+    try:
+        yield
+    finally:
+        telegram_retries.off = False
+
+def telegram_request(method, url, **kwargs):
+    return http_request(method, url, max_retries=0 if getattr(telegram_retries, "off", False) else None, **kwargs)
+
+telebot.apihelper.session = http_session
+if hasattr(telebot.apihelper, "CUSTOM_REQUEST_SENDER"):
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = telegram_request
+
+class TTLCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None: return default
+            if item[0] < time.time():
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return item[1]
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.items[key] = (time.time() + ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+    def pop(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
 client = None
 db = None
 users_col = None
+mongo_ready = threading.Event()
+startup_stats = {"import_seconds": None, "mongo_connect_seconds": None}
 
-try:
-    client = pymongo.MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    if DB_APPNAME:
-        db = client[DB_APPNAME]
-    else:
-        try:
-            db = client.get_default_database()
-        except:
-            db = None
-    if db is not None:
-        users_col = db.get_collection("users")
-        try:
-            users_col.create_index("user_id", unique=True)
-        except:
-            pass
-        for doc in users_col.find({}, {"user_id": 1, "gemini_key": 1}):
+def connect_mongo():
+    global client, db, users_col
+    start = time.time()
+    try:
+        client = pymongo.MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+        if DB_APPNAME:
+            database = client[DB_APPNAME]
+        else:
             try:
-                user_gemini_keys[int(doc["user_id"])] = doc.get("gemini_key")
+                database = client.get_default_database()
+            except:
+                database = None
+        if database is not None:
+            col = database.get_collection("users")
+            try:
+                col.create_index("user_id", unique=True)
             except:
                 pass
-except Exception as e:
-    logging.warning("MongoDB connection failed: %s", e)
+            users_col = col
+        db = database
+        startup_stats["mongo_connect_seconds"] = time.time() - start
+        logging.info("MongoDB ready in %.2fs", time.time() - start)
+    except Exception as e:
+        logging.warning("MongoDB connection failed: %s", e)
+    finally:
+        mongo_ready.set()
 
-def set_user_key_db(uid, key):
+threading.Thread(target=connect_mongo, name="mongo-connect", daemon=True).start()
+
+def get_db(wait=MONGO_WAIT_TIMEOUT):
+    mongo_ready.wait(wait)
+    return db
+
+def get_users_col(wait=MONGO_WAIT_TIMEOUT):
+    mongo_ready.wait(wait)
+    return users_col
+
+user_gemini_keys = TTLCache(USER_KEY_CACHE_SIZE)
+key_cache_stats = {"hits": 0, "misses": 0}
+pending_key_writes = {}
+pending_key_lock = threading.Lock()
+key_writer = None
+
+def flush_key_writes():
+    with pending_key_lock:
+        batch = dict(pending_key_writes)
+    if not batch: return
+    col = get_users_col()
     try:
-        if users_col is not None:
-            users_col.update_one({"user_id": uid}, {"$set": {"gemini_key": key, "updated_at": time.time()}}, upsert=True)
-        user_gemini_keys[uid] = key
+        if col is None: raise RuntimeError("MongoDB is not available")
+        col.bulk_write([pymongo.UpdateOne({"user_id": uid}, {"$set": {"gemini_key": key, "updated_at": ts}}, upsert=True) for uid, (key, ts) in batch.items()], ordered=False)
     except Exception as e:
-        logging.warning("Failed to set key in DB: %s", e)
-        user_gemini_keys[uid] = key
+        logging.warning("Failed to write %d keys to DB: %s", len(batch), e)
+        return
+    with pending_key_lock:
+        for uid, item in batch.items():
+            if pending_key_writes.get(uid) == item:
+                del pending_key_writes[uid]
+
+def run_key_writer():
+    while True:
+        time.sleep(KEY_FLUSH_INTERVAL)
+        flush_key_writes()
+
+def set_user_key_db(uid, key):
+    global key_writer
+    user_gemini_keys.set(uid, key, USER_KEY_CACHE_TTL)
+    with pending_key_lock:
+        pending_key_writes[uid] = (key, time.time())
+        if key_writer is None:
+            key_writer = threading.Thread(target=run_key_writer, name="key-writer", daemon=True)
+            key_writer.start()
 
 def get_user_key_db(uid):
+    key = user_gemini_keys.get(uid, False)
+    if key is not False:
+        key_cache_stats["hits"] += 1
+        return key
+    with pending_key_lock:
+        pending = pending_key_writes.get(uid)
+    if pending:
+        key_cache_stats["hits"] += 1
+        user_gemini_keys.set(uid, pending[0], USER_KEY_CACHE_TTL)
+        return pending[0]
+    key_cache_stats["misses"] += 1
     try:
-        if uid in user_gemini_keys:
-            return user_gemini_keys[uid]
-        if users_col is not None:
-            doc = users_col.find_one({"user_id": uid})
-            if doc:
-                key = doc.get("gemini_key")
-                user_gemini_keys[uid] = key
-                return key
+        col = get_users_col()
+        if col is not None:
+            doc = col.find_one({"user_id": uid}, {"gemini_key": 1})
+            key = doc.get("gemini_key") if doc else None
+            user_gemini_keys.set(uid, key, USER_KEY_CACHE_TTL if key else USER_KEY_MISS_TTL)
+            return key
     except Exception as e:
         logging.warning("Failed to get key from DB: %s", e)
-    return user_gemini_keys.get(uid)
+    return None
+
+def invalidate_user_key(uid):
+    with pending_key_lock:
+        if uid in pending_key_writes: return
+    user_gemini_keys.pop(uid)
+
+def key_rejected(exc):
+    while exc is not None:
+        resp = getattr(exc, "response", None)
+        if isinstance(exc, HTTPError) and resp is not None and resp.status_code in (401, 403):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+def get_startup_stats():
+    lookups = key_cache_stats["hits"] + key_cache_stats["misses"]
+    return dict(startup_stats, mongo_ready=mongo_ready.is_set(), key_cache_hit_ratio=key_cache_stats["hits"] / lookups if lookups else None, pending_key_writes=len(pending_key_writes))
+
+def encode_state(value):
+    raw = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return b"z" + zlib.compress(raw) if len(raw) >= STATE_COMPRESS_MIN else b"j" + raw
+
+def decode_state(blob):
+    if blob is None: return None
+    blob = bytes(blob)
+    raw = zlib.decompress(blob[1:]) if blob[:1] == b"z" else blob[1:]
+    return json.loads(raw.decode("utf-8"))
+
+class MemoryStateStore:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+    def _live(self, k):
+        item = self.items.get(k)
+        if item is None: return None
+        if item[0] < time.time():
+            del self.items[k]
+            return None
+        self.items.move_to_end(k)
+        return item
+    def _put(self, k, value, ttl, count=0):
+        self.items[k] = (time.time() + (ttl or self.ttl), value, count)
+        self.items.move_to_end(k)
+        while len(self.items) > self.max_entries:
+            self.items.popitem(last=False)
+    def get(self, ns, key):
+        with self.lock:
+            item = self._live((ns, key))
+        return decode_state(item[1]) if item else None
+    def get_count(self, ns, key):
+        with self.lock:
+            item = self._live((ns, key))
+        return item[2] if item else 0
+    def set(self, ns, key, value, ttl=None):
+        blob = encode_state(value)
+        with self.lock:
+            item = self._live((ns, key))
+            self._put((ns, key), blob, ttl, item[2] if item else 0)
+    def incr(self, ns, key, ttl=None):
+        with self.lock:
+            item = self._live((ns, key))
+            count = (item[2] if item else 0) + 1
+            self._put((ns, key), item[1] if item else None, ttl, count)
+            return count
+
+class SqliteStateStore:
+    def __init__(self, path, max_entries, ttl, table="state"):
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (ns TEXT, key TEXT, value BLOB, count INTEGER DEFAULT 0, expires REAL, last_used REAL, PRIMARY KEY (ns, key))")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table} (last_used)")
+        self.conn.commit()
+    def get(self, ns, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(f"SELECT value FROM {self.table} WHERE ns = ? AND key = ? AND expires >= ?", (ns, str(key), now)).fetchone()
+            if row:
+                self.conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE ns = ? AND key = ?", (now, ns, str(key)))
+                self.conn.commit()
+        return decode_state(row[0]) if row else None
+    def get_count(self, ns, key):
+        with self.lock:
+            row = self.conn.execute(f"SELECT count FROM {self.table} WHERE ns = ? AND key = ? AND expires >= ?", (ns, str(key), time.time())).fetchone()
+        return row[0] if row else 0
+    def set(self, ns, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(f"INSERT INTO {self.table} (ns, key, value, expires, last_used) VALUES (?, ?, ?, ?, ?) ON CONFLICT(ns, key) DO UPDATE SET value = excluded.value, expires = excluded.expires, last_used = excluded.last_used", (ns, str(key), encode_state(value), now + (ttl or self.ttl), now))
+            self.conn.commit()
+        self._maybe_evict()
+    def incr(self, ns, key, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(f"DELETE FROM {self.table} WHERE ns = ? AND key = ? AND expires < ?", (ns, str(key), now))
+            self.conn.execute(f"INSERT INTO {self.table} (ns, key, count, expires, last_used) VALUES (?, ?, 1, ?, ?) ON CONFLICT(ns, key) DO UPDATE SET count = count + 1, expires = excluded.expires, last_used = excluded.last_used", (ns, str(key), now + (ttl or self.ttl), now))
+            count = self.conn.execute(f"SELECT count FROM {self.table} WHERE ns = ? AND key = ?", (ns, str(key))).fetchone()[0]
+            self.conn.commit()
+        self._maybe_evict()
+        return count
+    def _maybe_evict(self):
+        self.writes += 1
+        if self.writes % 200 != 1: return
+        with self.lock:
+            self.conn.execute(f"DELETE FROM {self.table} WHERE expires < ?", (time.time(),))
+            self.conn.execute(f"DELETE FROM {self.table} WHERE rowid NOT IN (SELECT rowid FROM {self.table} ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+            self.conn.commit()
+
+class MongoStateStore:
+    def __init__(self, name, max_entries, ttl):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.writes = 0
+        self._col = None
+    @property
+    def col(self):
+        if self._col is None:
+            database = get_db()
+            if database is None: raise RuntimeError("MongoDB is not available")
+            col = database.get_collection(self.name)
+            col.create_index("expires")
+            col.create_index("last_used")
+            self._col = col
+        return self._col
+    def get(self, ns, key):
+        now = time.time()
+        doc = self.col.find_one_and_update({"_id": f"{ns}:{key}", "expires": {"$gte": now}}, {"$set": {"last_used": now}})
+        return decode_state(doc.get("value")) if doc else None
+    def get_count(self, ns, key):
+        doc = self.col.find_one({"_id": f"{ns}:{key}", "expires": {"$gte": time.time()}}, {"count": 1})
+        return doc.get("count", 0) if doc else 0
+    def set(self, ns, key, value, ttl=None):
+        now = time.time()
+        self.col.update_one({"_id": f"{ns}:{key}"}, {"$set": {"value": encode_state(value), "expires": now + (ttl or self.ttl), "last_used": now}}, upsert=True)
+        self._maybe_evict()
+    def incr(self, ns, key, ttl=None):
+        now = time.time()
+        self.col.delete_one({"_id": f"{ns}:{key}", "expires": {"$lt": now}})
+        doc = self.col.find_one_and_update({"_id": f"{ns}:{key}"}, {"$inc": {"count": 1}, "$set": {"expires": now + (ttl or self.ttl), "last_used": now}}, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        self._maybe_evict()
+        return doc.get("count", 1)
+    def _maybe_evict(self):
+        self.writes += 1
+        if self.writes % 200 != 1: return
+        self.col.delete_many({"expires": {"$lt": time.time()}})
+        extra = self.col.count_documents({}) - self.max_entries
+        if extra > 0:
+            old = [d["_id"] for d in self.col.find({}, {"_id": 1}).sort("last_used", 1).limit(extra)]
+            self.col.delete_many({"_id": {"$in": old}})
+
+def make_state_store(name, max_entries, ttl):
+    if STATE_BACKEND == "mongo":
+        return MongoStateStore(f"bot_{name}", max_entries, ttl)
+    if STATE_BACKEND == "sqlite":
+        return SqliteStateStore(STATE_DB, max_entries, ttl, table=name)
+    return MemoryStateStore(max_entries, ttl)
+
+state_store = make_state_store("state", STATE_MAX_ENTRIES, STATE_TTL)
+pref_store = make_state_store("prefs", STATE_PREF_MAX_ENTRIES, STATE_PREF_TTL)
 
 def get_user_mode(uid):
-    return user_mode.get(uid, "📄 Text File")
+    return pref_store.get("mode", uid) or "📄 Text File"
+
+def set_user_mode(uid, mode):
+    pref_store.set("mode", uid, mode)
+
+def get_transcription(chat_id, msg_id):
+    return state_store.get("transcript", f"{chat_id}:{msg_id}")
+
+def save_transcription(chat_id, msg_id, text, origin):
+    state_store.set("transcript", f"{chat_id}:{msg_id}", {"text": text, "origin": origin})
+
+class TranscriptCache:
+    def __init__(self, max_entries, ttl, sqlite_path):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.writes = 0
+        self.conn = None
+        self.col = None
+    def _mongo(self):
+        database = get_db()
+        if self.col is None and database is not None:
+            try:
+                col = database.get_collection("transcripts")
+                col.create_index("key", unique=True)
+                col.create_index("last_used")
+                self.col = col
+            except Exception as e:
+                logging.warning("Transcript cache collection unavailable: %s", e)
+        return self.col
+    def _sqlite(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS transcripts (key TEXT PRIMARY KEY, text TEXT, created REAL, last_used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used)")
+        return self.conn
+    def get(self, key):
+        text = self._get(key)
+        metrics.inc("bot_cache_requests_total", cache="transcript", result="hit" if text is not None else "miss")
+        return text
+    def _get(self, key):
+        now = time.time()
+        try:
+            col = self._mongo()
+            if col is not None:
+                doc = col.find_one_and_update({"key": key, "last_used": {"$gte": now - self.ttl}}, {"$set": {"last_used": now}})
+                return doc.get("text") if doc else None
+            with self.lock:
+                conn = self._sqlite()
+                row = conn.execute("SELECT text FROM transcripts WHERE key = ? AND last_used >= ?", (key, now - self.ttl)).fetchone()
+                if row:
+                    conn.execute("UPDATE transcripts SET last_used = ? WHERE key = ?", (now, key))
+                    conn.commit()
+                return row[0] if row else None
+        except Exception as e:
+            logging.warning("Transcript cache read failed: %s", e)
+            return None
+    def put(self, keys, text):
+        now = time.time()
+        try:
+            col = self._mongo()
+            for key in keys:
+                if col is not None:
+                    col.update_one({"key": key}, {"$set": {"text": text, "last_used": now}, "$setOnInsert": {"created": now}}, upsert=True)
+                else:
+                    with self.lock:
+                        conn = self._sqlite()
+                        conn.execute("INSERT INTO transcripts (key, text, created, last_used) VALUES (?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET text = excluded.text, last_used = excluded.last_used", (key, text, now, now))
+                        conn.commit()
+            self.writes += 1
+            if self.writes % 100 == 1:
+                self.evict()
+        except Exception as e:
+            logging.warning("Transcript cache write failed: %s", e)
+    def evict(self):
+        cutoff = time.time() - self.ttl
+        col = self._mongo()
+        if col is not None:
+            col.delete_many({"last_used": {"$lt": cutoff}})
+            extra = col.count_documents({}) - self.max_entries
+            if extra > 0:
+                old = [d["_id"] for d in col.find({}, {"_id": 1}).sort("last_used", 1).limit(extra)]
+                col.delete_many({"_id": {"$in": old}})
+            return
+        with self.lock:
+            conn = self._sqlite()
+            conn.execute("DELETE FROM transcripts WHERE last_used < ?", (cutoff,))
+            conn.execute("DELETE FROM transcripts WHERE key NOT IN (SELECT key FROM transcripts ORDER BY last_used DESC LIMIT ?)", (self.max_entries,))
+            conn.commit()
+    def get_or_compute(self, key, compute):
+        while True:
+            text = self.get(key)
+            if text is not None:
+                return text
+            with self.lock:
+                entry = self.inflight.get(key)
+                leader = entry is None
+                if leader:
+                    entry = {"event": threading.Event(), "text": None}
+                    self.inflight[key] = entry
+            if leader: break
+            entry["event"].wait()
+            if entry["text"] is not None:
+                return entry["text"]
+        try:
+            entry["text"] = compute()
+            return entry["text"]
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            entry["event"].set()
+
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_SIZE, TRANSCRIPT_CACHE_TTL, TRANSCRIPT_CACHE_DB)
+
+def download_telegram_file(remote_path, dest_path):
+    url = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(BOT_TOKEN, remote_path)
+    h, size = hashlib.sha256(), 0
+    try:
+        with metrics.timer("download"), http_request("GET", url, stream=True, timeout=REQUEST_TIMEOUT_GEMINI) as resp:
+            resp.raise_for_status()
+            with open(dest_path, 'wb') as f:
+                for block in resp.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    size += len(block)
+                    if size > MAX_UPLOAD_SIZE: raise RuntimeError(f"File is larger than {MAX_UPLOAD_MB}MB")
+                    h.update(block)
+                    f.write(block)
+    finally:
+        metrics.inc("bot_bytes_total", size, direction="download")
+    return h.hexdigest()
+
+TRANSCODE_PROFILES = {
+    "wav": {"ext": "wav", "mime": "audio/wav", "args": ["-acodec", "pcm_s16le", "-ac", "1", "-ar", "16000"]},
+    "flac": {"ext": "flac", "mime": "audio/flac", "args": ["-acodec", "flac", "-ac", "1", "-ar", "16000"]},
+    "opus": {"ext": "ogg", "mime": "audio/ogg", "args": ["-acodec", "libopus", "-b:a", "24k", "-application", "voip", "-ac", "1", "-ar", "16000"]},
+}
+PASSTHROUGH_FORMATS = {"wav": "audio/wav", "mp3": "audio/mp3", "aiff": "audio/aiff", "aac": "audio/aac", "ogg": "audio/ogg", "flac": "audio/flac"}
+
+def get_transcode_profile(name=None):
+    return TRANSCODE_PROFILES.get(name or TRANSCODE_PROFILE, TRANSCODE_PROFILES["wav"])
+
+def build_audio_filters():
+    filters = []
+    if TRIM_SILENCE:
+        filters.append(f"silenceremove=start_periods=1:start_threshold={TRIM_NOISE_DB}:start_silence={TRIM_KEEP_SILENCE}"
+                       f":stop_periods=-1:stop_duration={TRIM_MIN_SILENCE}:stop_threshold={TRIM_NOISE_DB}:stop_silence={TRIM_KEEP_SILENCE}")
+    tempo = min(2.0, max(0.5, SPEECH_TEMPO))
+    if tempo != 1.0:
+        filters.append(f"atempo={tempo}")
+    return filters
+
+AUDIO_FILTERS = build_audio_filters()
+
+def filter_args():
+    return ["-af", ",".join(AUDIO_FILTERS)] if AUDIO_FILTERS else []
+
+def output_seconds(stderr):
+    times = re.findall(r"time=(\d+):(\d+):([\d.]+)", stderr.decode("utf-8", "ignore"))
+    if not times: return None
+    h, m, sec = times[-1]
+    return int(h) * 3600 + int(m) * 60 + float(sec)
+
+def report_preprocessing(name, before, after):
+    if not AUDIO_FILTERS or not before or after is None: return
+    saved = max(0.0, before - after)
+    metrics.inc("bot_audio_seconds_total", before, stage="input")
+    metrics.inc("bot_audio_seconds_total", after, stage="uploaded")
+    logging.info("Preprocessing %s saved %.1fs of %.1fs audio (%.0f%%)", name, saved, before, 100 * saved / before)
 
-def convert_to_wav(input_path: str) -> str:
+def probe_media(path):
+    try:
+        command = [FFPROBE_BINARY, "-v", "error", "-show_entries", "format=format_name,duration:stream=codec_type,codec_name", "-of", "json", path]
+        out = json.loads(subprocess.run(command, check=True, capture_output=True, timeout=60).stdout.decode("utf-8", "ignore"))
+        streams = out.get("streams", [])
+        fmt = out.get("format", {})
+        return {
+            "format": fmt.get("format_name", "").split(",")[0],
+            "duration": float(fmt["duration"]) if fmt.get("duration") else None,
+            "has_audio": any(st.get("codec_type") == "audio" for st in streams),
+            "has_video": any(st.get("codec_type") == "video" and st.get("codec_name") not in ("mjpeg", "png") for st in streams),
+        }
+    except Exception as e:
+        logging.warning("ffprobe failed for %s: %s", path, e)
+        return None
+
+def passthrough_mime(info):
+    if not info or info["has_video"] or not info["has_audio"]: return None
+    return PASSTHROUGH_FORMATS.get(info["format"])
+
+def transcode_audio(input_path: str, profile_name=None, filters=True, duration=None):
     if not FFMPEG_BINARY: raise RuntimeError("FFmpeg binary not found.")
-    output_path = os.path.join(DOWNLOADS_DIR, f"{os.path.basename(input_path).split('.')[0]}_converted.wav")
-    command = [FFMPEG_BINARY, "-i", input_path, "-acodec", "pcm_s16le", "-ac", "1", "-ar", "16000", output_path, "-y"]
-    subprocess.run(command, check=True, capture_output=True, timeout=REQUEST_TIMEOUT_GEMINI)
-    return output_path
+    profile = get_transcode_profile(profile_name)
+    output_path = os.path.join(DOWNLOADS_DIR, f"{os.path.basename(input_path).split('.')[0]}_converted.{profile['ext']}")
+    command = [FFMPEG_BINARY, "-i", input_path, "-vn", "-sn", "-dn"] + (filter_args() if filters else []) + profile["args"] + [output_path, "-y"]
+    start = time.time()
+    with metrics.timer("transcode"):
+        result = subprocess.run(command, check=True, capture_output=True, timeout=REQUEST_TIMEOUT_GEMINI)
+    if filters:
+        report_preprocessing(os.path.basename(input_path), duration, output_seconds(result.stderr))
+    logging.info("Transcoded %s (%s) in %.2fs: %d -> %d bytes", os.path.basename(input_path), profile["ext"], time.time() - start, os.path.getsize(input_path), os.path.getsize(output_path))
+    return output_path, profile["mime"]
 
 def gemini_api_call(endpoint, payload, key, model_name, headers=None):
-    url = f"https://generativelanguage.googleapis.com/v1beta/{endpoint}?key={key}"
-    resp = requests.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT_GEMINI)
+    url = f"{GEMINI_API_BASE}/v1beta/{endpoint}?key={key}"
+    resp = http_request("POST", url, retry_statuses=(500, 502, 503, 504), headers=headers, json=payload, timeout=REQUEST_TIMEOUT_GEMINI)
     resp.raise_for_status()
     return resp.json()
 
-def upload_and_transcribe_gemini(file_path: str, key: str) -> str:
-    original_path, converted_path = file_path, None
-    if os.path.splitext(file_path)[1].lower() not in [".wav", ".mp3", ".aiff", ".aac", ".ogg", ".flac"]:
-        converted_path = convert_to_wav(file_path)
-        file_path = converted_path
-    file_size = os.path.getsize(file_path)
-    mime_type = "audio/wav"
-    uploaded_name = None
-    try:
-        upload_url = f"https://generativelanguage.googleapis.com/upload/v1beta/files?key={key}"
-        headers = {
-            "X-Goog-Upload-Protocol": "raw", "X-Goog-Upload-Command": "start, upload, finalize",
-            "X-Goog-Upload-Header-Content-Length": str(file_size), "Content-Type": mime_type
-        }
-        with open(file_path, 'rb') as f:
-            up_resp = requests.post(upload_url, headers=headers, data=f.read(), timeout=REQUEST_TIMEOUT_GEMINI).json()
-        uploaded_name = up_resp.get("name", up_resp.get("file", {}).get("name"))
-        uploaded_uri = up_resp.get("uri", up_resp.get("file", {}).get("uri"))
-        if not uploaded_name: raise RuntimeError("Upload failed.")
-        prompt = "Transcribe this audio and provide a clean transcription. Do not add intro phrases."
-        payload = {"contents": [{"parts": [{"fileData": {"mimeType": mime_type, "fileUri": uploaded_uri}}, {"text": prompt}]}]}
-        
-        last_exc = None
+def gemini_stream_call(endpoint, payload, key, on_text):
+    url = f"{GEMINI_API_BASE}/v1beta/{endpoint}?alt=sse&key={key}"
+    parts = []
+    with http_request("POST", url, retry_statuses=(500, 502, 503, 504), json=payload, stream=True, timeout=REQUEST_TIMEOUT_GEMINI) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if not line.startswith(b"data:"): continue
+            data = json.loads(line[5:].decode("utf-8"))
+            candidates = data.get("candidates") or [{}]
+            delta = "".join(part.get("text", "") for part in candidates[0].get("content", {}).get("parts", []))
+            if delta:
+                parts.append(delta)
+                on_text(delta)
+    return "".join(parts)
+
+def generate_with_fallback(payload, key, label="Gemini API call", on_text=None):
+    last_exc = None
+    for attempt in range(HTTP_MAX_RETRIES + 1):
         for model in [GEMINI_MODEL, GEMINI_FALLBACK_MODEL]:
+            if model != GEMINI_MODEL:
+                metrics.inc("bot_gemini_fallback_total")
             try:
-                data = gemini_api_call(f"models/{model}:generateContent", payload, key, model, headers={"Content-Type": "application/json"})
+                with metrics.timer("generate"):
+                    if on_text:
+                        return gemini_stream_call(f"models/{model}:streamGenerateContent", payload, key, on_text)
+                    data = gemini_api_call(f"models/{model}:generateContent", payload, key, model, headers={"Content-Type": "application/json"})
                 return data["candidates"][0]["content"]["parts"][0]["text"]
             except HTTPError as e:
                 last_exc = e
-                logging.warning(f"Gemini transcription failed with model {model} (Status {e.response.status_code}): {e}")
+                logging.warning(f"{label} failed with model {model} (Status {e.response.status_code}): {e}")
                 if e.response.status_code != 429:
                     raise
+                metrics.inc("bot_gemini_429_total", model=model)
             except Exception as e:
                 last_exc = e
-                logging.warning(f"Gemini transcription failed with model {model}: {e}")
+                logging.warning(f"{label} failed with model {model}: {e}")
                 raise
-        raise RuntimeError(f"Gemini transcription failed after model rotation. Last error: {last_exc}")
+        if attempt < HTTP_MAX_RETRIES:
+            time.sleep(retry_delay(attempt, last_exc.response))
+    raise RuntimeError(f"{label} failed after model rotation. Last error: {last_exc}")
+
+class GeminiFileDeleter:
+    def __init__(self, interval, max_attempts):
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.pending = []
+        self.lock = threading.Lock()
+        self.thread = None
+    def submit(self, name, key):
+        with self.lock:
+            self.pending.append((name, key, 0))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="gemini-file-deleter", daemon=True)
+                self.thread.start()
+    def _delete(self, name, key):
+        resp = http_request("DELETE", f"{GEMINI_API_BASE}/v1beta/{name}?key={key}", max_retries=0, timeout=10)
+        if resp.status_code != 404:
+            resp.raise_for_status()
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        retry = []
+        for name, key, attempts in batch:
+            try:
+                self._delete(name, key)
+            except Exception as e:
+                if attempts + 1 < self.max_attempts:
+                    retry.append((name, key, attempts + 1))
+                else:
+                    logging.warning("Giving up deleting Gemini file %s: %s", name, e)
+        if retry:
+            with self.lock:
+                self.pending.extend(retry)
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning("Gemini file deleter failed: %s", e)
+
+gemini_file_deleter = GeminiFileDeleter(DELETE_BATCH_INTERVAL, DELETE_MAX_ATTEMPTS)
+
+NOT_PROBED = object()
+
+def upload_and_transcribe_gemini(file_path: str, key: str, info=NOT_PROBED, on_text=None, preprocess=True) -> str:
+    converted_path = None
+    if info is NOT_PROBED: info = probe_media(file_path)
+    mime_type = None if preprocess and AUDIO_FILTERS else passthrough_mime(info)
+    if not mime_type:
+        converted_path, mime_type = transcode_audio(file_path, filters=preprocess, duration=info and info["duration"])
+        file_path = converted_path
+    file_size = os.path.getsize(file_path)
+    metrics.inc("bot_bytes_total", file_size, direction="upload")
+    uploaded_name = None
+    try:
+        if file_size <= INLINE_MAX_SIZE:
+            logging.info("Sending %d bytes (%s) inline to Gemini", file_size, mime_type)
+            with open(file_path, 'rb') as f:
+                media_part = {"inlineData": {"mimeType": mime_type, "data": base64.b64encode(f.read()).decode("ascii")}}
+        else:
+            logging.info("Uploading %d bytes (%s) to Gemini", file_size, mime_type)
+            upload_url = f"{GEMINI_API_BASE}/upload/v1beta/files?key={key}"
+            headers = {
+                "X-Goog-Upload-Protocol": "raw", "X-Goog-Upload-Command": "start, upload, finalize",
+                "X-Goog-Upload-Header-Content-Length": str(file_size), "Content-Type": mime_type
+            }
+            with metrics.timer("upload"), open(file_path, 'rb') as f:
+                up_resp = http_request("POST", upload_url, headers=headers, data=f, timeout=REQUEST_TIMEOUT_GEMINI).json()
+            uploaded_name = up_resp.get("name", up_resp.get("file", {}).get("name"))
+            uploaded_uri = up_resp.get("uri", up_resp.get("file", {}).get("uri"))
+            if not uploaded_name: raise RuntimeError("Upload failed.")
+            media_part = {"fileData": {"mimeType": mime_type, "fileUri": uploaded_uri}}
+        prompt = "Transcribe this audio and provide a clean transcription. Do not add intro phrases."
+        payload = {"contents": [{"parts": [media_part, {"text": prompt}]}]}
+        return generate_with_fallback(payload, key, "Gemini transcription", on_text=on_text)
 
     finally:
         if uploaded_name:
-            try: requests.delete(f"https://generativelanguage.googleapis.com/v1beta/{uploaded_name}?key={key}", timeout=5)
-            except: pass
+            gemini_file_deleter.submit(uploaded_name, key)
         if converted_path and os.path.exists(converted_path):
             os.remove(converted_path)
 
-def ask_gemini(text, instruction, key):
-    payload = {"contents": [{"parts": [{"text": f"{instruction}\n\n{text}"}]}]}
-    
+def detect_silences(path):
+    command = [FFMPEG_BINARY, "-hide_banner", "-nostats", "-i", path, "-vn", "-af", f"silencedetect=noise={SILENCE_NOISE_DB}:d={SILENCE_MIN_DURATION}", "-f", "null", "-"]
+    out = subprocess.run(command, capture_output=True, timeout=REQUEST_TIMEOUT_GEMINI).stderr.decode("utf-8", "ignore")
+    starts = [float(x) for x in re.findall(r"silence_start: ([\d.]+)", out)]
+    ends = [float(x) for x in re.findall(r"silence_end: ([\d.]+)", out)]
+    return [(a + b) / 2 for a, b in zip(starts, ends)]
+
+def plan_chunks(duration, silences):
+    bounds, start = [], 0.0
+    while duration - start > CHUNK_MAX_SECONDS:
+        candidates = [t for t in silences if start + CHUNK_MIN_SECONDS <= t <= start + CHUNK_MAX_SECONDS]
+        end = candidates[-1] if candidates else start + CHUNK_MAX_SECONDS
+        bounds.append((start, end))
+        start = end
+    if bounds and duration - start < CHUNK_TAIL_MIN_SECONDS:
+        start = bounds.pop()[0]
+    bounds.append((start, duration))
+    return bounds
+
+def split_audio(input_path, bounds):
+    base = os.path.basename(input_path).split('.')[0]
+    profile = get_transcode_profile()
+    paths, kept = [], 0.0
+    for i, (start, end) in enumerate(bounds):
+        out = os.path.join(DOWNLOADS_DIR, f"{base}_chunk{i:03d}.{profile['ext']}")
+        command = [FFMPEG_BINARY, "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}", "-i", input_path, "-vn", "-sn", "-dn"] + filter_args() + profile["args"] + [out, "-y"]
+        paths.append(out)
+        try:
+            result = subprocess.run(command, check=True, capture_output=True, timeout=REQUEST_TIMEOUT_GEMINI)
+        except Exception:
+            for p in paths:
+                if os.path.exists(p): os.remove(p)
+            raise
+        kept += output_seconds(result.stderr) or (end - start)
+    report_preprocessing(os.path.basename(input_path), bounds[-1][1], kept)
+    return paths
+
+key_semaphores = {}
+key_semaphores_lock = threading.Lock()
+
+def get_key_semaphore(key):
+    with key_semaphores_lock:
+        if key not in key_semaphores:
+            key_semaphores[key] = threading.BoundedSemaphore(max(1, CHUNK_CONCURRENCY))
+        return key_semaphores[key]
+
+def is_transient_error(e):
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        return status >= 500
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+def transcribe_chunk(path, key):
     last_exc = None
-    for model in [GEMINI_MODEL, GEMINI_FALLBACK_MODEL]:
+    for attempt in range(CHUNK_RETRIES + 1):
+        if attempt: time.sleep(2 ** attempt)
         try:
-            data = gemini_api_call(f"models/{model}:generateContent", payload, key, model, headers={"Content-Type": "application/json"})
-            return data["candidates"][0]["content"]["parts"][0]["text"]
-        except HTTPError as e:
-            last_exc = e
-            logging.warning(f"Gemini API call failed with model {model} (Status {e.response.status_code}): {e}")
-            if e.response.status_code != 429:
-                raise
+            with get_key_semaphore(key):
+                return upload_and_transcribe_gemini(path, key, preprocess=False)
         except Exception as e:
             last_exc = e
-            logging.warning(f"Gemini API call failed with model {model}: {e}")
+            logging.warning(f"Chunk {os.path.basename(path)} failed (attempt {attempt + 1}): {e}")
+            if not is_transient_error(e): raise
+    raise RuntimeError(f"Chunk transcription failed: {last_exc}") from last_exc
+
+def transcribe_media(file_path: str, key: str, on_text=None) -> str:
+    info = probe_media(file_path)
+    duration = info and info["duration"]
+    if not duration or duration <= CHUNK_MAX_SECONDS:
+        return upload_and_transcribe_gemini(file_path, key, info, on_text=on_text)
+    bounds = plan_chunks(duration, detect_silences(file_path))
+    if len(bounds) == 1:
+        return upload_and_transcribe_gemini(file_path, key, info, on_text=on_text)
+    chunks = []
+    try:
+        chunks = split_audio(file_path, bounds)
+        parts = []
+        pool = ThreadPoolExecutor(max_workers=max(1, CHUNK_CONCURRENCY))
+        try:
+            for future in [pool.submit(transcribe_chunk, p, key) for p in chunks]:
+                part = (future.result() or "").strip()
+                if not part: continue
+                if on_text: on_text(("\n" if parts else "") + part)
+                parts.append(part)
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
             raise
+        pool.shutdown()
+        return "\n".join(parts)
+    finally:
+        for p in chunks:
+            if os.path.exists(p): os.remove(p)
+
+def ask_gemini(text, instruction, key):
+    payload = {"contents": [{"parts": [{"text": f"{instruction}\n\n{text}"}]}]}
+    return generate_with_fallback(payload, key)
+
+def action_cache_key(kind, text, extra):
+    return hashlib.sha256("\0".join([kind, extra, GEMINI_MODEL, GEMINI_FALLBACK_MODEL, text]).encode("utf-8")).hexdigest()
 
-    if last_exc:
-        raise RuntimeError(f"Gemini API failed after model rotation. Last error: {last_exc}")
+def get_cached_action(kind, text, extra):
+    res = state_store.get("action_result", action_cache_key(kind, text, extra))
+    metrics.inc("bot_cache_requests_total", cache="action", result="hit" if res is not None else "miss")
+    return res
+
+def set_cached_action(kind, text, extra, result):
+    state_store.set("action_result", action_cache_key(kind, text, extra), result, ttl=ACTION_CACHE_TTL)
+
+def translate_prompt(label):
+    return f"Translate this text in to language {label}. No extra text ONLY return the translated text."
+
+def translate_batch(text, codes, key):
+    labels = dict((code, lbl) for lbl, code in LANGS)
+    targets = "\n".join(f"{code}: {labels.get(code, code)}" for code in codes)
+    instruction = f"Translate this text into each of the following languages. Return ONLY a JSON object mapping each language code to its translated text, no extra text.\n{targets}"
+    payload = {"contents": [{"parts": [{"text": f"{instruction}\n\n{text}"}]}], "generationConfig": {"responseMimeType": "application/json"}}
+    out = json.loads(generate_with_fallback(payload, key))
+    return {code: out[code] for code in codes if isinstance(out.get(code), str) and out[code].strip()}
+
+def translate_text(text, code, label, key):
+    res = get_cached_action("translate", text, code)
+    if res is not None: return res
+    codes = [code] + [c for c in TRANSLATE_PREFETCH_LANGS if c != code and get_cached_action("translate", text, c) is None]
+    if len(codes) > 1 and len(text) <= TRANSLATE_BATCH_MAX_CHARS:
+        try:
+            results = translate_batch(text, codes, key)
+            for c, translated in results.items():
+                set_cached_action("translate", text, c, translated)
+            if code in results: return results[code]
+        except Exception as e:
+            logging.warning("Batch translation failed, falling back to single language: %s", e)
+    res = ask_gemini(text, translate_prompt(label), key)
+    set_cached_action("translate", text, code, res)
+    return res
+
+def split_text(text, size):
+    parts = []
+    while len(text) > size:
+        cut = max(text.rfind("\n", 0, size), text.rfind(". ", 0, size))
+        cut = cut + 1 if cut > size // 2 else size
+        parts.append(text[:cut])
+        text = text[cut:]
+    if text.strip(): parts.append(text)
+    return parts
+
+def summarize_text(text, prompt, key):
+    res = get_cached_action("summarize", text, prompt)
+    if res is not None: return res
+    if len(text) > SUMMARY_CHUNK_CHARS:
+        part_prompt = "Summarize this part of a longer text in the original language, keeping every key point. No extra text — return only the summary."
+        with ThreadPoolExecutor(max_workers=max(1, CHUNK_CONCURRENCY)) as pool:
+            partials = list(pool.map(lambda part: ask_gemini(part, part_prompt, key), split_text(text, SUMMARY_CHUNK_CHARS)))
+        res = ask_gemini("\n\n".join(partials), prompt, key)
     else:
-        raise RuntimeError("Gemini API failed with no specific error captured.")
+        res = ask_gemini(text, prompt, key)
+    set_cached_action("summarize", text, prompt, res)
+    return res
 
 def build_action_keyboard(text_len):
     btns = [[InlineKeyboardButton("⭐️ Get translating", callback_data="translate_menu|")]]
@@ -215,10 +1129,41 @@ def build_summarize_keyboard(origin):
     ]
     return InlineKeyboardMarkup(btns)
 
+member_cache = TTLCache(MEMBER_CACHE_SIZE)
+channel_cache = TTLCache(16)
+JOINED_STATUSES = ['member', 'administrator', 'creator']
+
+def is_channel_member(uid):
+    joined = member_cache.get(uid)
+    metrics.inc("bot_cache_requests_total", cache="member", result="hit" if joined is not None else "miss")
+    if joined is not None: return joined
+    joined = bot.get_chat_member(REQUIRED_CHANNEL, uid).status in JOINED_STATUSES
+    member_cache.set(uid, joined, MEMBER_CACHE_TTL if joined else MEMBER_CACHE_NEGATIVE_TTL)
+    return joined
+
+def get_channel_pinned():
+    if channel_cache.get("pinned", False) is False:
+        pinned = None
+        if getattr(bot.get_chat_member(REQUIRED_CHANNEL, bot.user.id), "status", "") in ["administrator", "creator"]:
+            pinned = getattr(bot.get_chat(REQUIRED_CHANNEL), "pinned_message", None)
+        channel_cache.set("pinned", pinned, CHANNEL_INFO_TTL)
+    return channel_cache.get("pinned")
+
+@bot.chat_member_handler()
+def chat_member_update(update):
+    chat = update.chat
+    if not REQUIRED_CHANNEL: return
+    if str(chat.id) != REQUIRED_CHANNEL and (chat.username or "").lower() != REQUIRED_CHANNEL.lstrip("@").lower(): return
+    user = update.new_chat_member.user
+    joined = update.new_chat_member.status in JOINED_STATUSES
+    member_cache.set(user.id, joined, MEMBER_CACHE_TTL if joined else MEMBER_CACHE_NEGATIVE_TTL)
+    if user.id == bot.user.id:
+        channel_cache.pop("pinned")
+
 def ensure_joined(message):
     if not REQUIRED_CHANNEL: return True
     try:
-        if bot.get_chat_member(REQUIRED_CHANNEL, message.from_user.id).status in ['member', 'administrator', 'creator']: return True
+        if is_channel_member(message.from_user.id): return True
     except: pass
     clean = REQUIRED_CHANNEL.replace("@", "")
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("🔗 Join", url=f"https://t.me/{clean}")]])
@@ -274,7 +1219,7 @@ def choose_mode(message):
 def mode_cb(call):
     if not ensure_joined(call.message): return
     mode = call.data.split("|")[1]
-    user_mode[call.from_user.id] = mode
+    set_user_mode(call.from_user.id, mode)
     try:
         bot.edit_message_text(f"you choosed: {mode}", call.message.chat.id, call.message.message_id, reply_markup=None)
     except:
@@ -288,7 +1233,7 @@ def lang_cb(call):
     except:
         pass
     _, code, lbl, origin = call.data.split("|")
-    process_text_action(call, origin, f"Translate to {lbl}", f"Translate this text in to language {lbl}. No extra text ONLY return the translated text.")
+    process_text_action(call, origin, f"Translate to {lbl}", translate_prompt(lbl), lang=(code, lbl))
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith('translate_menu|'))
 def action_cb(call):
@@ -324,7 +1269,7 @@ def summopt_cb(call):
         prompt = "Summarize this text in the original language as a bulleted list of main points. No extra text — return only the summary."
     process_text_action(call, origin, f"Summarize ({style})", prompt)
 
-def process_text_action(call, origin_msg_id, log_action, prompt_instr):
+def process_text_action(call, origin_msg_id, log_action, prompt_instr, lang=None):
     if not ensure_joined(call.message): return
     chat_id, msg_id = call.message.chat.id, call.message.message_id
     try:
@@ -332,10 +1277,10 @@ def process_text_action(call, origin_msg_id, log_action, prompt_instr):
     except:
         origin_id = call.message.message_id
 
-    data = user_transcriptions.get(chat_id, {}).get(origin_id)
+    data = get_transcription(chat_id, origin_id)
     if not data:
         if call.message.reply_to_message:
-             data = user_transcriptions.get(chat_id, {}).get(call.message.reply_to_message.message_id)
+             data = get_transcription(chat_id, call.message.reply_to_message.message_id)
 
     if not data:
         bot.answer_callback_query(call.id, "Data not found (expired). Resend file.", show_alert=True)
@@ -352,11 +1297,16 @@ def process_text_action(call, origin_msg_id, log_action, prompt_instr):
     bot.send_chat_action(chat_id, 'typing')
     
     try:
-        res = ask_gemini(text, prompt_instr, user_key)
+        with metrics.timer("translate" if lang else "summarize"):
+            if lang:
+                res = translate_text(text, lang[0], lang[1], user_key)
+            else:
+                res = summarize_text(text, prompt_instr, user_key)
         if "Summarize" not in log_action:
-            action_usage[key] = action_usage.get(key, 0) + 1 
+            state_store.incr("action_usage", key)
         send_long_text(chat_id, res, data["origin"], call.from_user.id, log_action)
     except Exception as e:
+        if key_rejected(e): invalidate_user_key(call.from_user.id)
         bot.send_message(chat_id, f"❌ Error: {e}")
 
 @bot.message_handler(content_types=['voice', 'audio', 'video', 'document'])
@@ -372,17 +1322,13 @@ def handle_media(message):
         bot.reply_to(message, "first send me Gemini key 🤓")
         try:
             if REQUIRED_CHANNEL:
-                me = bot.get_me()
                 try:
-                    bot_member = bot.get_chat_member(REQUIRED_CHANNEL, me.id)
-                    if getattr(bot_member, "status", "") in ["administrator", "creator"]:
-                        chat_info = bot.get_chat(REQUIRED_CHANNEL)
-                        pinned = getattr(chat_info, "pinned_message", None)
-                        if pinned:
-                            try:
-                                bot.forward_message(message.chat.id, REQUIRED_CHANNEL, pinned.message_id)
-                            except Exception as e:
-                                logging.warning("Failed to forward pinned message: %s", e)
+                    pinned = get_channel_pinned()
+                    if pinned:
+                        try:
+                            bot.forward_message(message.chat.id, REQUIRED_CHANNEL, pinned.message_id)
+                        except Exception as e:
+                            logging.warning("Failed to forward pinned message: %s", e)
                 except Exception as e:
                     logging.warning("Failed to check bot admin status or forward pinned message: %s", e)
         except Exception as e:
@@ -390,22 +1336,51 @@ def handle_media(message):
         return
     bot.send_chat_action(message.chat.id, 'typing')
     file_path = os.path.join(DOWNLOADS_DIR, f"temp_{message.id}_{media.file_unique_id}")
-    try:
+    stream = StreamingReply(message.chat.id, message.id) if STREAM_TRANSCRIPTS else None
+    def transcribe():
         file_info = bot.get_file(media.file_id)
-        downloaded = bot.download_file(file_info.file_path)
-        with open(file_path, 'wb') as f: f.write(downloaded)
-        text = upload_and_transcribe_gemini(file_path, user_key)
-        if not text: raise ValueError("Empty response")
-        sent = send_long_text(message.chat.id, text, message.id, message.from_user.id)
-        if sent:
-            user_transcriptions.setdefault(message.chat.id, {})[sent.message_id] = {"text": text, "origin": message.id}
-            bot.edit_message_reply_markup(message.chat.id, sent.message_id, reply_markup=build_action_keyboard(len(text)))
+        content_key = f"sha256:{download_telegram_file(file_info.file_path, file_path)}"
+        text = transcript_cache.get(content_key)
+        if text is None:
+            text = transcribe_media(file_path, user_key, on_text=stream and stream.feed)
+            if not text: raise ValueError("Empty response")
+        transcript_cache.put([f"file:{media.file_unique_id}", content_key], text)
+        return text
+    metrics.gauge_add("bot_transcriptions_in_flight", 1)
+    sent_id = None
+    try:
+        with metrics.timer("transcription"):
+            text = transcript_cache.get_or_compute(f"file:{media.file_unique_id}", transcribe)
+        if stream and stream.sent:
+            if len(text) > MAX_MESSAGE_CHUNK and get_user_mode(message.from_user.id) != "Split messages":
+                stream.discard()
+            else:
+                try:
+                    sent_id = stream.finish(text)
+                except Exception as e:
+                    logging.warning("Finishing streamed transcript failed, resending: %s", e)
+                    stream.discard()
+        if sent_id is None:
+            sent = send_long_text(message.chat.id, text, message.id, message.from_user.id)
+            sent_id = sent and sent.message_id
+        if sent_id:
+            save_transcription(message.chat.id, sent_id, text, message.id)
+            bot.edit_message_reply_markup(message.chat.id, sent_id, reply_markup=build_action_keyboard(len(text)))
+        metrics.inc("bot_transcriptions_total", result="ok")
     except Exception as e:
+        metrics.inc("bot_transcriptions_total", result="error")
+        if stream and sent_id is None: stream.discard()
+        if key_rejected(e): invalidate_user_key(message.from_user.id)
         bot.reply_to(message, f"❌ Error: {e}")
     finally:
+        metrics.gauge_add("bot_transcriptions_in_flight", -1)
         if os.path.exists(file_path): os.remove(file_path)
 
 def send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
+    with metrics.timer("send"):
+        return _send_long_text(chat_id, text, reply_id, uid, action)
+
+def _send_long_text(chat_id, text, reply_id, uid, action):
     mode = get_user_mode(uid)
     if len(text) > MAX_MESSAGE_CHUNK:
         if mode == "Split messages":
@@ -414,29 +1389,218 @@ def send_long_text(chat_id, text, reply_id, uid, action="Transcript"):
                 sent = bot.send_message(chat_id, text[i:i+MAX_MESSAGE_CHUNK], reply_to_message_id=reply_id)
             return sent
         else:
-            fname = os.path.join(DOWNLOADS_DIR, f"{action}.txt")
-            with open(fname, "w", encoding="utf-8") as f: f.write(text)
-            sent = bot.send_document(chat_id, open(fname, 'rb'), caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id)
-            os.remove(fname)
-            return sent
+            buf = io.BytesIO(text.encode("utf-8"))
+            return bot.send_document(chat_id, buf, visible_file_name=f"{action}.txt", caption="Open this file and copy the text inside 👍", reply_to_message_id=reply_id)
     return bot.send_message(chat_id, text, reply_to_message_id=reply_id)
 
+class StreamingReply:
+    def __init__(self, chat_id, reply_id):
+        self.chat_id = chat_id
+        self.reply_id = reply_id
+        self.interval = STREAM_GROUP_EDIT_INTERVAL if chat_id < 0 else STREAM_EDIT_INTERVAL
+        self.text = ""
+        self.sent = []
+        self.next_flush = 0.0
+    def feed(self, delta):
+        self.text += delta
+        if time.time() < self.next_flush: return
+        try:
+            self.flush()
+        except Exception as e:
+            logging.warning("Streaming transcript update failed: %s", e)
+            self.next_flush = time.time() + self.interval
+    def chunks(self):
+        return [self.text[i:i+MAX_MESSAGE_CHUNK] for i in range(0, len(self.text), MAX_MESSAGE_CHUNK)]
+    def flush(self):
+        for i, chunk in enumerate(self.chunks()):
+            if i < len(self.sent) and self.sent[i][1] == chunk: continue
+            try:
+                with no_telegram_retries():
+                    if i < len(self.sent):
+                        bot.edit_message_text(chunk, self.chat_id, self.sent[i][0])
+                        self.sent[i][1] = chunk
+                    elif not chunk.strip():
+                        break
+                    else:
+                        msg = bot.send_message(self.chat_id, chunk, reply_to_message_id=self.reply_id)
+                        self.sent.append([msg.message_id, chunk])
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", self.interval)
+                    self.next_flush = time.time() + float(retry_after)
+                    return False
+                if "message is not modified" not in e.description: raise
+                self.sent[i][1] = chunk
+        self.next_flush = time.time() + self.interval
+        return True
+    def finish(self, text):
+        self.text = text
+        for _ in range(HTTP_MAX_RETRIES + 1):
+            if [chunk for _, chunk in self.sent] == self.chunks(): break
+            time.sleep(max(0, min(self.next_flush - time.time(), HTTP_RETRY_AFTER_MAX)))
+            if self.flush(): break
+        else:
+            raise RuntimeError("Telegram kept rate limiting transcript edits")
+        keep = max(1, -(-len(text) // MAX_MESSAGE_CHUNK))
+        for message_id, _ in self.sent[keep:]:
+            bot.delete_message(self.chat_id, message_id)
+        del self.sent[keep:]
+        return self.sent[-1][0]
+    def discard(self):
+        for message_id, _ in self.sent:
+            try:
+                bot.delete_message(self.chat_id, message_id)
+            except Exception as e:
+                logging.warning("Failed to delete streamed message %s: %s", message_id, e)
+        self.sent = []
+
+class UpdateQueue:
+    def __init__(self, workers, max_size, max_per_user, max_inflight, dedup_size, control_workers=1):
+        self.workers = max(1, workers)
+        self.control_workers = max(1, control_workers)
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self.max_inflight = max(1, max_inflight)
+        self.dedup_size = dedup_size
+        self.pending = OrderedDict()
+        self.control = deque()
+        self.inflight = {}
+        self.seen = OrderedDict()
+        self.size = 0
+        self.cond = threading.Condition()
+        self.threads = []
+    def _start(self):
+        if self.threads: return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"update-worker-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+        for i in range(self.control_workers):
+            t = threading.Thread(target=self._run_control, name=f"control-worker-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+    def submit(self, uid, update_id, job, media=True):
+        with self.cond:
+            if update_id is not None:
+                if update_id in self.seen: return "duplicate"
+            if self.size + len(self.control) >= self.max_size: return "full"
+            if media:
+                q = self.pending.setdefault(uid, deque())
+                if len(q) >= self.max_per_user:
+                    if not q: del self.pending[uid]
+                    return "user_full"
+            if update_id is not None:
+                self.seen[update_id] = time.time()
+                while len(self.seen) > self.dedup_size:
+                    self.seen.popitem(last=False)
+            if media:
+                q.append((time.time(), job))
+                self.size += 1
+            else:
+                self.control.append((time.time(), job))
+            self._start()
+            self.cond.notify_all()
+            return "queued"
+    def _run_job(self, queued_at, job):
+        metrics.observe("bot_stage_seconds", time.time() - queued_at, stage="queue_wait")
+        try:
+            with metrics.timer("update"), profile_if_slow("update"):
+                job()
+        except Exception as e:
+            logging.warning("Update job failed: %s", e)
+    def _run_control(self):
+        while True:
+            with self.cond:
+                while not self.control:
+                    self.cond.wait()
+                queued_at, job = self.control.popleft()
+            self._run_job(queued_at, job)
+    def _next(self):
+        for uid, q in self.pending.items():
+            if self.inflight.get(uid, 0) < self.max_inflight:
+                job = q.popleft()
+                del self.pending[uid]
+                if q: self.pending[uid] = q
+                self.size -= 1
+                self.inflight[uid] = self.inflight.get(uid, 0) + 1
+                return uid, job
+        return None
+    def _run(self):
+        while True:
+            with self.cond:
+                nxt = self._next()
+                while nxt is None:
+                    self.cond.wait()
+                    nxt = self._next()
+            uid, (queued_at, job) = nxt
+            try:
+                self._run_job(queued_at, job)
+            finally:
+                with self.cond:
+                    self.inflight[uid] -= 1
+                    if not self.inflight[uid]: del self.inflight[uid]
+                    self.cond.notify_all()
+    def stats(self):
+        with self.cond:
+            return {"queued": self.size + len(self.control), "users": len(self.pending), "inflight": sum(self.inflight.values()), "control_queued": len(self.control)}
+
+update_queue = UpdateQueue(WORKER_COUNT, MAX_QUEUE_SIZE, MAX_USER_QUEUE, MAX_USER_INFLIGHT, DEDUP_CACHE_SIZE, CONTROL_WORKER_COUNT)
+
+def update_user_id(update):
+    for obj in (update.message, update.edited_message, update.callback_query, update.chat_member, update.channel_post):
+        user = getattr(obj, "from_user", None)
+        if user: return user.id
+    chat = getattr(update.message or update.channel_post, "chat", None)
+    return chat.id if chat else 0
+
+def is_media_update(update):
+    msg = update.message
+    return msg is not None and msg.content_type in ('voice', 'audio', 'video', 'document')
+
 @flask_app.route("/", methods=["GET"])
 def index():
     return "Bot Running", 200
 
+@flask_app.route("/health", methods=["GET"])
+def health():
+    return dict(get_startup_stats(), queue=update_queue.stats()), 200
+
+@flask_app.route(METRICS_PATH, methods=["GET"])
+def metrics_endpoint():
+    queue = update_queue.stats()
+    gauges = [(("bot_update_queue_depth", ()), queue["queued"]), (("bot_update_jobs_in_flight", ()), queue["inflight"]),
+              (("bot_mongo_connected", ()), int(db is not None)), (("bot_pending_key_writes", ()), len(pending_key_writes))]
+    if startup_stats["import_seconds"] is not None:
+        gauges.append((("bot_cold_start_seconds", ()), startup_stats["import_seconds"]))
+    counters = [(("bot_cache_requests_total", (("cache", "user_key"), ("result", "hit"))), key_cache_stats["hits"]),
+                (("bot_cache_requests_total", (("cache", "user_key"), ("result", "miss"))), key_cache_stats["misses"])]
+    for host, st in get_http_stats().items():
+        for field in ("requests", "errors", "retries"):
+            counters.append(((f"bot_http_{field}_total", (("host", host),)), st[field]))
+        counters.append((("bot_http_seconds_total", (("host", host),)), st["seconds"]))
+    return Response(render_metrics(gauges, counters), mimetype="text/plain; version=0.0.4")
+
 @flask_app.route(WEBHOOK_PATH, methods=['POST'])
 def webhook():
     if request.headers.get('content-type') == 'application/json':
-        bot.process_new_updates([Update.de_json(request.get_data().decode('utf-8'))])
+        update = Update.de_json(request.get_data().decode('utf-8'))
+        uid = update_user_id(update)
+        status = update_queue.submit(uid, update.update_id, lambda: bot.process_new_updates([update]), media=is_media_update(update))
+        if status == "full":
+            logging.warning("Update queue full, asking Telegram to redeliver update %s", update.update_id)
+            return '', 503
+        if status == "user_full" and update.message:
+            update_queue.submit(uid, None, lambda: bot.reply_to(update.message, "Please wait, your previous files are still being processed ⏳"), media=False)
         return '', 200
     abort(403)
 
+startup_stats["import_seconds"] = time.time() - STARTED_AT
+
 if __name__ == "__main__":
     if WEBHOOK_URL:
         bot.remove_webhook()
         time.sleep(0.5)
-        bot.set_webhook(url=WEBHOOK_URL)
+        bot.set_webhook(url=WEBHOOK_URL, allowed_updates=["message", "callback_query", "chat_member"])
         flask_app.run(host="0.0.0.0", port=PORT)
     else:
         print("Webhook URL not set, exiting.")